@@ -1,4 +1,5 @@
 import argparse
+import collections
 import numpy as np
 import sys
 import cv2
@@ -39,16 +40,27 @@ def parse_args() -> argparse.Namespace:
         required=True,
         type=str
     )
+    parser.add_argument(
+        "--dnn_target",
+        type=str,
+        default="cuda_fp16",
+        help="Device to run YOLO on. OpenCV falls back to cpu if it is built without CUDA.",
+        choices=["cpu", "cuda", "cuda_fp16"],
+    )
 
     return parser.parse_args()
 
 
 class StreamingClientObserver():
     def __init__(self):
-        self.images = {}
+        # rgb_frames is a queue that stores the most recent RGB image
+        # from the Aria glasses. A new image replaces an image that
+        # was not taken by the main loop yet.
+        self.rgb_frames = collections.deque(maxlen=1)
 
     def on_image_received(self, image: np.array, record: ImageDataRecord):
-        self.images[record.camera_id] = image
+        if record.camera_id == aria.CameraId.Rgb:
+            self.rgb_frames.append(image)
 
 
 def quit_keypress():
@@ -80,9 +92,31 @@ def update_iptables() -> None:
     subprocess.run(update_iptables_cmd)
 
 
+def prepare_frame(image: np.ndarray) -> np.ndarray:
+    """
+    Rotate the image from the Aria glasses clockwise and swap 
+    RGB to BGR order (expected by OpenCV) in a single copy.
+    """
+    # np.rot90 and the reversed channel axis are both views, so the only 
+    # pass over the pixels is the copy into a new C-contiguous array.
+    return np.ascontiguousarray(np.rot90(image, -1)[..., ::-1])
+
+
+# OpenCV DNN (backend, target) for each --dnn_target option
+DNN_TARGETS = {
+    "cpu": (cv2.dnn.DNN_BACKEND_OPENCV, cv2.dnn.DNN_TARGET_CPU),
+    "cuda": (cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA),
+    "cuda_fp16": (cv2.dnn.DNN_BACKEND_CUDA, cv2.dnn.DNN_TARGET_CUDA_FP16),
+}
+
+
 # Load and prepare YOLO model
 def load_yolo(args):
     net = cv2.dnn.readNet(args.yolo_weights, args.yolo_cfg)
+    # Run the model on the GPU of Jetson (in half precision by default)
+    backend, target = DNN_TARGETS[args.dnn_target]
+    net.setPreferableBackend(backend)
+    net.setPreferableTarget(target)
     classes = []
     with open("./yolo_models/coco.names.txt", "r") as f:
         classes = [line.strip() for line in f.readlines()]
@@ -95,25 +129,42 @@ def load_yolo(args):
     return net, classes, output_layers
 
 
+# Size of the (square) input image of the YOLO model
+MODEL_INPUT_SIZE = 416
+
+
 # Detect objects using YOLO
 def detect_objects(img, net, outputLayers):
-    blob = cv2.dnn.blobFromImage(img, scalefactor=0.00392, size=(416, 416), mean=(0, 0, 0), swapRB=True, crop=False)
+    blob = cv2.dnn.blobFromImage(img, scalefactor=0.00392, size=(MODEL_INPUT_SIZE, MODEL_INPUT_SIZE), mean=(0, 0, 0), swapRB=True, crop=False)
     net.setInput(blob)
     outputs = net.forward(outputLayers)
     return outputs
 
 
-def draw_labels_and_boxes(img, boxes, confidences, class_ids, classes):
+def make_label_cache(classes):
+    """
+    Precompute the label text and the color of each class once, 
+    instead of building them for every box of every frame.
+    """
+    labels = [str(c) for c in classes]
+    # One fixed color per class (OpenCV expects a tuple of Python ints)
+    rng = np.random.default_rng(0)
+    colors = [tuple(int(v) for v in color) for color in rng.integers(0, 256, size=(len(classes), 3))]
+    return labels, colors
+
+
+def draw_labels_and_boxes(img, boxes, confidences, class_ids, labels, colors):
     indexes = cv2.dnn.NMSBoxes(boxes, confidences, 0.5, 0.4)
     font = cv2.FONT_HERSHEY_PLAIN
 
-    for i in range(len(boxes)):
-        if i in indexes:
-            x, y, w, h = boxes[i]
-            label = str(classes[class_ids[i]])
-            color = (0, 255, 0)
-            cv2.rectangle(img, (x, y), (x + w, y + h), color, 2)
-            cv2.putText(img, label, (x, y + 30), font, 1, color, 2)
+    # Visit only the boxes kept by NMS instead of testing 
+    # every box for membership in the array of kept indexes
+    for i in np.asarray(indexes, dtype=int).reshape(-1):
+        x, y, w, h = boxes[i]
+        label = labels[class_ids[i]]
+        color = colors[class_ids[i]]
+        cv2.rectangle(img, (x, y), (x + w, y + h), color, 2)
+        cv2.putText(img, label, (x, y + 30), font, 1, color, 2)
     return img
 
 
@@ -207,20 +258,19 @@ def main():
     #cv2.setWindowProperty(rgb_window, cv2.WND_PROP_TOPMOST, 1)
     cv2.moveWindow(rgb_window, 50, 50)
     net, classes, output_layers = load_yolo(args)
+    labels, colors = make_label_cache(classes)
 
     while not quit_keypress():
-        if aria.CameraId.Rgb in observer.images:
-            rgb_image = np.rot90(observer.images[aria.CameraId.Rgb], -1)
-            rgb_image = cv2.cvtColor(rgb_image, cv2.COLOR_BGR2RGB)
+        if observer.rgb_frames:
+            rgb_image = prepare_frame(observer.rgb_frames.pop())
             height, width, channels = rgb_image.shape
 
             # YOLO object detection
             outputs = detect_objects(rgb_image, net, output_layers)
             boxes, confidences, class_ids = process_detections(outputs, width, height)
-            indexes = cv2.dnn.NMSBoxes(boxes, confidences, 0.5, 0.4)
-            img_with_boxes = draw_labels_and_boxes(rgb_image.copy(), boxes, confidences, class_ids, classes)
+            # Draw in place, the frame is not used after it is displayed
+            img_with_boxes = draw_labels_and_boxes(rgb_image, boxes, confidences, class_ids, labels, colors)
             cv2.imshow(rgb_window, img_with_boxes)
-            del observer.images[aria.CameraId.Rgb]
 
     print("Stop listening to image data")
     streaming_client.unsubscribe()
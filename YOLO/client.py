@@ -5,10 +5,9 @@ import numpy as np
 import threading
 import time
 import cv2
-import aria.sdk as aria
 
-from communication import recv_array, send_array
-from aria_stream import device_stream, device_subscribe, draw_labels_and_boxes, quit_keypress
+from communication import configure_socket, encode_frame, make_schema, recv_message, recv_schema, release_array, send_message, send_schema
+from aria_stream import device_stream, device_subscribe, draw_labels_and_boxes, make_label_cache, prepare_frame, quit_keypress
 
 
 # Client constants
@@ -20,12 +19,12 @@ SERVER_PORT = 5050
 # Global counters for debug
 recv_count = 0
 sent_count = 0
-stop_event = threading.Event()  # --> event is created in False state
 
-# most_recent_buff is a queue that stores tuples 
-# of the most recent images from the Aria glasses 
-# with its timestamps sent by client to server 
-most_recent_buff = collections.deque(maxlen=128)
+# most_recent_buff is an ordered dictionary that maps 
+# timestamps sent by client to server to the most recent 
+# images from the Aria glasses (oldest first)
+MOST_RECENT_BUFF_SIZE = 128
+most_recent_buff: "collections.OrderedDict[int, np.ndarray]" = collections.OrderedDict()
 
 # most_recent_bbox is a queue that stores a tuple
 # of the most recent result recieved from the server.
@@ -58,13 +57,17 @@ def parse_args() -> argparse.Namespace:
         "--device_ip", 
         help="IP address to connect to the device over wifi"
     )
+    parser.add_argument(
+        "--jpeg_quality",
+        type=int,
+        default=85,
+        help="JPEG quality (1-100) of images sent to the server. Use 0 to send raw images.",
+    )
 
     return parser.parse_args()
 
 
-def recv_thread(conn: socket.socket, 
-                stop_event: threading.Event,
-                ) -> None:
+def recv_thread(conn: socket.socket) -> None:
     """
     Thread function to recieve result from the server.
     """
@@ -72,20 +75,20 @@ def recv_thread(conn: socket.socket,
     global most_recent_bbox
 
 
+    # Receive the layout of results once
+    schema = recv_schema(conn)
+
     while (1):
 
-        if stop_event.is_set():
+        # The main thread shuts the socket down to stop this thread,
+        # so the blocked receive returns None immediately.
+        message = None if schema is None else recv_message(conn, schema)
+
+        if message is None:
+            print(f"[{threading.current_thread().name}] Client received None from server. Stopping.", flush=True)
             break
         
-        recv_ts = recv_array(conn)
-        recb_boxes = recv_array(conn)
-        recv_confidences = recv_array(conn)
-        recv_class_ids = recv_array(conn)
-
-        if ((recv_ts is None) or (recb_boxes is None) or (recv_confidences is None) or (recv_class_ids is None)):
-            print(f"[{threading.current_thread().name}] Client received None from server. Skipping.", flush=True)
-            continue
-        
+        recv_ts, (recb_boxes, recv_confidences, recv_class_ids) = message
         print(f"[{threading.current_thread().name}] Client received (ts, boxes, confidences, class_ids) from server.", flush=True)
         recv_count += 1
 
@@ -102,6 +105,9 @@ def run_client(classes):
     global most_recent_buff
     global most_recent_bbox
 
+    # Label text and color of each class for visualisation
+    labels, colors = make_label_cache(classes)
+
     # Get camera info
     print("CONNECT CAMERA...", flush=True)
     streaming_manager, streaming_client, device_client, device = device_stream(args)
@@ -120,38 +126,48 @@ def run_client(classes):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conn:
         
         print("CONNECT TO SERVER..", flush=True)
+        configure_socket(conn)
         conn.connect((SERVER_HOST, SERVER_PORT))
 
         # Second thread is recieving files
         print("START RecvThread...", flush=True)
-        recv_obj = threading.Thread(target=recv_thread, args=(conn, stop_event), name="RecvThread")
+        recv_obj = threading.Thread(target=recv_thread, args=(conn,), name="RecvThread")
         recv_obj.start()
 
         print("SOCKET IS READY FOR TRANSMISSION", flush=True)
 
+        # Layout of (time, image) messages, sent once with the first image
+        frame_schema = None
+
         # gcount = 0
         while not quit_keypress():
-            if aria.CameraId.Rgb in observer.images:
+            if observer.rgb_frames:
 
                 # Health state of a camera
                 # gcount = 0
                 
                 # Capture the image from the camera
-                rgb_image = np.rot90(observer.images[aria.CameraId.Rgb], -1)
-                rgb_image = cv2.cvtColor(rgb_image, cv2.COLOR_BGR2RGB)
+                rgb_image = prepare_frame(observer.rgb_frames.pop())
                 
                 # Get current time in milliseconds rounded to nearest int
-                curr_ts = np.array([1000 * time.time()], dtype="i8")
+                curr_ts = int(1000 * time.time())
 
                 # Send the image from the camera to Jetson server
-                send_array(conn, curr_ts)
-                send_array(conn, rgb_image)
+                if args.jpeg_quality > 0:
+                    message = [encode_frame(rgb_image, quality=args.jpeg_quality)]
+                else:
+                    message = [rgb_image]
+                if frame_schema is None:
+                    frame_schema = make_schema(message)
+                    send_schema(conn, frame_schema)
+                send_message(conn, curr_ts, message)
                 print(f"[{threading.current_thread().name}] Client sent (time, image) to server", flush=True)
-                most_recent_buff.append((curr_ts, rgb_image))
+                most_recent_buff[curr_ts] = rgb_image
+                most_recent_buff.move_to_end(curr_ts)
+                while len(most_recent_buff) > MOST_RECENT_BUFF_SIZE:
+                    most_recent_buff.popitem(last=False)
                 sent_count += 1
 
-                del observer.images[aria.CameraId.Rgb]
-
                 # Visualize if we have received bounding boxes, confidences, and class IDs
                 if len(most_recent_buff) > 0 and len(most_recent_bbox) > 0:
                     
@@ -160,22 +176,25 @@ def run_client(classes):
                     recv_ts, recv_boxes, recv_confidences, recv_class_ids = most_recent_bbox.pop()
 
                     # Find the image on client side by using recieved timestamp from server
-                    img = -1
-                    for (tic, img) in most_recent_buff:
-                        if tic == recv_ts:
-                            break
-                        if tic  > recv_ts:
-                            raise ValueError("Wrong timestamp")
-                    
-                    # Visualisation
-                    img_with_boxes = draw_labels_and_boxes(
-                        img=img.copy(), 
-                        boxes=recv_boxes, 
-                        confidences=recv_confidences, 
-                        class_ids=recv_class_ids, 
-                        classes=classes
-                    )
-                    cv2.imshow(rgb_window, img_with_boxes)
+                    # (and take it out, since it is drawn on and displayed only once)
+                    img = most_recent_buff.pop(recv_ts, None)
+                    if img is None:
+                        print(f"[{threading.current_thread().name}] Image for received timestamp is not in buffer. Skipping.", flush=True)
+                    else:
+                        # Visualisation (in place, without copying the image)
+                        img_with_boxes = draw_labels_and_boxes(
+                            img=img, 
+                            boxes=recv_boxes.astype(np.int32),  # int16 on the wire
+                            confidences=recv_confidences, 
+                            class_ids=recv_class_ids, 
+                            labels=labels,
+                            colors=colors
+                        )
+                        cv2.imshow(rgb_window, img_with_boxes)
+
+                    # Return the received arrays to the pool for the next recv_message
+                    for arr in (recv_boxes, recv_confidences, recv_class_ids):
+                        release_array(arr)
             # else:
             #     time.sleep(0.1)
             #     gcount += 1
@@ -185,9 +204,12 @@ def run_client(classes):
             #     break
 
         # Send termination signal to server
-        stop_event.set()
-        send_array(conn, None) # tic
-        send_array(conn, None) # arr
+        # (the server receives the end of the stream instead of a next message)
+        # and stop the receiving thread without waiting for the next result
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # Already disconnected by the server
         print(f"[{threading.current_thread().name}] Client sent termination signal. Disconected from server.", flush=True)
         recv_obj.join()
 
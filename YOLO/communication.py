@@ -2,87 +2,273 @@
 Communication protocol between server and client (handshake).
 """
 
+import collections
 import socket
+import cv2
 import numpy as np
 import struct
 from typing import Union
 
+# libjpeg-turbo is optional, OpenCV is used to encode and decode JPEG without it
+try:
+    import turbojpeg
+    jpeg = turbojpeg.TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    turbojpeg = None
+    jpeg = None
 
-# def send_array(sock: socket.socket, array: np.ndarray | None) -> None:
-def send_array(sock: socket.socket, array: Union[np.ndarray, None]) -> None:
+
+# Maximum number of spare arrays kept in the pool for each (shape, dtype)
+ARRAY_POOL_SIZE = 4
+
+# Size of the socket send and receive buffers in bytes
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+
+# DTYPE_CODES is a dictionary that maps the dtypes used in the pipeline 
+# to 1-byte codes sent instead of the dtype string. Other dtypes are 
+# sent with OTHER_DTYPE_CODE followed by the dtype string.
+DTYPE_CODES = {np.dtype(dtype): code for code, dtype in enumerate(["i8", "f4", "i2", "u1", "i4", "f8", "f2"])}
+CODE_DTYPES = {code: dtype for dtype, code in DTYPE_CODES.items()}
+OTHER_DTYPE_CODE = 255
+
+# array_pool is a dictionary that maps (shape, dtype) to a queue 
+# of arrays which were released after use and can be reused by 
+# recv_message instead of allocating a new array for every message.
+array_pool = {}
+
+
+def configure_socket(sock: socket.socket) -> None:
     """
-    Function to send a NumPy array through a socket connection.
+    Function to set up TCP options of a socket for low-latency streaming.
     """
-    if array is None:
-        # Send 0 as the signal for termination
-        # (we can check ndim == 0 in recv_array)
-        sock.sendall(struct.pack("i", 0))
-        return
+    # Disable Nagle's algorithm, so that small messages (e.g. results) are 
+    # sent immediately instead of waiting for the ACK of the previous segment.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Enlarge the buffers, so that a whole image fits into them.
+    # Should be called before connect/listen for the TCP window to use it.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+
+def encode_frame(image: np.ndarray, quality: int) -> np.ndarray:
+    """
+    Function to compress a BGR image into JPEG bytes stored in a 1-dimensional uint8 array.
+    """
+    if jpeg is not None:
+        jpeg_bytes = jpeg.encode(image, quality=quality, pixel_format=turbojpeg.TJPF_BGR)
+        return np.frombuffer(jpeg_bytes, dtype=np.uint8)
+    
+    _, jpeg_array = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return jpeg_array.reshape(-1)
+
+
+# OpenCV decoding flags for each JPEG size reduction factor
+IMREAD_REDUCED = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def jpeg_reduce(array: np.ndarray, min_size: int) -> int:
+    """
+    Function to choose the largest factor (1, 2, 4 or 8) by which a JPEG image can be 
+    downscaled while decoding, so that its shorter side stays at least 'min_size'.
+    """
+    # The size of the image is read from the JPEG header, which needs libjpeg-turbo
+    if array.ndim == 3 or jpeg is None:
+        return 1
+    
+    width, height = jpeg.decode_header(array)[:2]
+    reduce = 1
+    for factor in (2, 4, 8):
+        # Downscaled sizes are rounded up
+        if -(-min(height, width) // factor) >= min_size:
+            reduce = factor
+    return reduce
+
+
+def decode_frame(array: np.ndarray, reduce: int = 1) -> np.ndarray:
+    """
+    Function to decompress an image encoded by encode_frame into a BGR image.
+    JPEG images are downscaled by 'reduce' (1, 2, 4 or 8) while decoding.
+    Raw images (with height, width and channels dimensions) are returned as is.
+    """
+    if array.ndim == 3:
+        return array
     
-    # Send the number of dimensions in the array as integer.
+    # The downscaling is done on the DCT coefficients as part of decoding, 
+    # so the full size image is never produced.
+    if jpeg is not None:
+        return jpeg.decode(array, pixel_format=turbojpeg.TJPF_BGR, scaling_factor=(1, reduce))
+    
+    return cv2.imdecode(array, IMREAD_REDUCED[reduce])
+
+
+def acquire_array(shape: tuple, dtype: np.dtype) -> np.ndarray:
+    """
+    Function to take an array from the pool or allocate a new one.
+    """
+    pool = array_pool.get((shape, dtype))
+    if pool:
+        try:
+            return pool.pop()
+        except IndexError:
+            pass # Emptied by another thread
+    return np.empty(shape, dtype=dtype)
+
+
+def release_array(array: np.ndarray) -> None:
+    """
+    Function to return an array received by recv_message to the pool.
+    The array must not be used by the caller afterwards.
+    """
+    key = (array.shape, array.dtype)
+    pool = array_pool.setdefault(key, collections.deque(maxlen=ARRAY_POOL_SIZE))
+    pool.append(array)
+
+
+def pack_header(array: np.ndarray) -> bytes:
+    """
+    Helper function to pack the description of a NumPy array (ndim, shape, dtype) into bytes.
+    """
+    # The number of dimensions in the array as integer.
     # For example, if the array has a shape (3, 4, 5), ndim will be 3.
-    # The struct.pack("i", ndim) converts the integer into a binary representation, 
-    # and sock.sendall sends this binary data over the network.
+    # The shape of the array follows as a sequence of integers (3, 4, and 5),
+    # then the 1-byte code of the dtype. For a dtype without a code, the 
+    # length of the dtype string and the dtype string itself (e.g., '>f4') 
+    # encoded as UTF-8 bytes follow the code.
+    # This allows the receiver to reconstruct the dtype of the array correctly.
     ndim = array.ndim
-    sock.sendall(struct.pack("i", ndim))
-
-    # Send the shape of the array as a sequence of integers in binary format. 
-    # For example, if the array has a shape (3, 4, 5), 
-    # the sizes of each dimension (3, 4, and 5) are sent in sequence.
-    # This is done by packing the shape information into a binary format and sending it over the network.
-    sock.sendall(struct.pack(f"{ndim}i", *array.shape))
-
-    # Send the length of the dtype string as an integer.
-    # Convert the NumPy dtype object to its string representation (e.g., '<f4' for float32).
-    # Encode this string representation into bytes using UTF-8 encoding.
-    # Calculate the length of this byte sequence. 
-    # Pack this length as a 4-byte integer ("i") in binary format.
-    # Send the packed length over the network. 
-    # This informs the receiver of the number of bytes to expect for the dtype string.
+    dtype_code = DTYPE_CODES.get(array.dtype)
+    if dtype_code is not None:
+        return struct.pack(f"i{ndim}iB", ndim, *array.shape, dtype_code)
+    
     dtype_str_bytes = array.dtype.str.encode("utf-8")
-    sock.sendall(struct.pack("i", len(dtype_str_bytes)))
+    header = struct.pack(f"i{ndim}iB", ndim, *array.shape, OTHER_DTYPE_CODE)
+    return header + struct.pack("i", len(dtype_str_bytes)) + dtype_str_bytes
+
+
+def array_bytes(array: np.ndarray) -> np.ndarray:
+    """
+    Helper function to get the data of a NumPy array as a flat block of bytes.
+    """
+    # Viewing a C-contiguous array as flat uint8 exposes its memory as a block 
+    # of bytes without the allocation and copy made by array.tobytes().
+    return np.ascontiguousarray(array).reshape(-1).view(np.uint8)
 
-    # Send the dtype string itself encoded as UTF-8 bytes.
-    # After sending the length of the dtype string, the next step is to send the actual dtype string.
-    # Convert the dtype string (e.g., '<f4' for float32) to UTF-8 encoded bytes using the encode method.
-    # Send these bytes over the network. 
-    # This allows the receiver to reconstruct the dtype of the array correctly.
-    sock.sendall(dtype_str_bytes)
 
-    # Send the actual array data as bytes.
-    # Convert the NumPy array to a byte representation using the tobytes method.
-    # This method flattens the array and serializes its data into a continuous block of bytes.
-    # For example, an array with shape (2, 2) and dtype float32 will be converted into bytes that
-    # represent its raw memory content in a flattened form. 
-    # This byte stream is then sent over the network.
-    sock.sendall(array.tobytes())
+# def send_arrays(sock: socket.socket, arrays: list[np.ndarray]) -> None:
+def send_arrays(sock: socket.socket, arrays: list) -> None:
+    """
+    Function to send a list of NumPy arrays through a socket connection as one message.
+    """
+    # The message consists of the number of arrays, the headers 
+    # of all arrays, and then the data of all arrays in the same order.
+    header = struct.pack("i", len(arrays)) + b"".join(pack_header(array) for array in arrays)
+    sendmsg_all(sock, [header] + [array_bytes(array) for array in arrays])
 
 
-# def recv_data(sock: socket.socket, size: int) -> bytes | None:
-def recv_data(sock: socket.socket, size: int) -> Union[bytes, None]:
+def make_schema(arrays: list) -> list:
+    """
+    Function to make the schema of messages from a list of example arrays.
+    The schema is a list of empty arrays with the dtype and the shape 
+    (except for the length of the first dimension) of each array.
+    """
+    return [np.empty((0,) + array.shape[1:], dtype=array.dtype) for array in arrays]
+
+
+def send_schema(sock: socket.socket, schema: list) -> None:
+    """
+    Function to send the schema of the following messages once after connecting.
+    """
+    # Arrays of the schema are empty, so only their headers are sent
+    send_arrays(sock, schema)
+
+
+def send_message(sock: socket.socket, tic: int, arrays: list) -> None:
+    """
+    Function to send a timestamp and a list of NumPy arrays laid out as described by the schema sent before.
+    """
+    # The dtypes and shapes are known to the receiver from the schema, so the 
+    # header of the message is only the timestamp (as 8-byte integer) and 
+    # the length of the first dimension of each array.
+    header = struct.pack(f"q{len(arrays)}i", tic, *(len(array) for array in arrays))
+    sendmsg_all(sock, [header] + [array_bytes(array) for array in arrays])
+
+
+def sendmsg_all(sock: socket.socket, buffers: list) -> None:
+    """
+    Helper function to send a list of buffers through a socket as one message.
+    """
+    # Some platforms (e.g. Windows) do not provide sendmsg.
+    if not hasattr(sock, "sendmsg"):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+
+    buffers = [memoryview(buffer).cast("B") for buffer in buffers]
+    while buffers:
+        # Unlike sendall, sendmsg may send only part of the data,
+        # so drop the sent bytes and send the rest again.
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+
+
+# def recv_data(sock: socket.socket, size: int) -> bytearray | None:
+def recv_data(sock: socket.socket, size: int) -> Union[bytearray, None]:
     """
     Helper function to receive 'size' bytes from the socket.
     """
-    data = b""
-    while len(data) < size:
-        packet = sock.recv(size - len(data))
+    # Receive into a preallocated buffer instead of concatenating packets,
+    # which would reallocate and copy the data received so far every time.
+    data = bytearray(size)
+    view = memoryview(data)
+    n = 0
+    while n < size:
+        nbytes = sock.recv_into(view[n:], size - n)
 
         # If the server or client closes the connection or there is a network error,
-        # sock.recv returns an empty byte string (b""). In such cases, the function 
+        # sock.recv_into returns 0. In such cases, the function 
         # returns None, indicating the connection is closed.
         
-        if packet == b"":
+        if nbytes == 0:
             return None # Connection closed
 
-        data += packet
+        n += nbytes
 
     return data
 
 
-# def recv_array(sock: socket.socket) -> np.ndarray | None:
-def recv_array(sock: socket.socket) -> Union[np.ndarray, None]:
+def recv_into(sock: socket.socket, array: np.ndarray) -> bool:
+    """
+    Helper function to receive bytes from the socket directly into the memory of 'array'.
+    """
+    view = memoryview(array.reshape(-1).view(np.uint8))
+    size = len(view)
+    n = 0
+    while n < size:
+        nbytes = sock.recv_into(view[n:], size - n)
+
+        # sock.recv_into returns 0 when the connection is closed.
+        if nbytes == 0:
+            return False # Connection closed
+
+        n += nbytes
+
+    return True
+
+
+# def recv_header(sock: socket.socket) -> tuple[tuple, np.dtype] | None:
+def recv_header(sock: socket.socket) -> Union[tuple, None]:
     """
-    Function to receive a NumPy array from the socket connection.
+    Helper function to receive the shape and dtype of a NumPy array packed by pack_header.
     """
     # Recieve the number of dimensions
     ndim_bytes = recv_data(sock=sock, size=struct.calcsize("i"))
@@ -90,15 +276,15 @@ def recv_array(sock: socket.socket) -> Union[np.ndarray, None]:
         return None # Connection closed
     ndim = struct.unpack("i", ndim_bytes)[0]
 
-    # Check for termination signal
-    if ndim == 0:
-        return None # Connection closed
-
-    # Recieve the shape of the array
-    shape_bytes = recv_data(sock=sock, size=struct.calcsize(f"{ndim}i"))
+    # Recieve the shape of the array and the dtype code
+    shape_bytes = recv_data(sock=sock, size=struct.calcsize(f"{ndim}iB"))
     if shape_bytes is None:
         return None # Connection closed
-    shape = struct.unpack(f"{ndim}i", shape_bytes)
+    *shape, dtype_code = struct.unpack(f"{ndim}iB", shape_bytes)
+    shape = tuple(shape)
+
+    if dtype_code != OTHER_DTYPE_CODE:
+        return shape, CODE_DTYPES[dtype_code]
 
     # Receive the dtype string length
     dtype_str_len_bytes = recv_data(sock=sock, size=struct.calcsize("i"))
@@ -112,14 +298,64 @@ def recv_array(sock: socket.socket) -> Union[np.ndarray, None]:
         return None  # Connection closed
     dtype_str = dtype_str_bytes.decode('utf-8')
 
-    # Receive the actual data
-    dtype = np.dtype(dtype_str)
-    buffer_size = np.prod(shape) * dtype.itemsize
-    data_bytes = recv_data(sock=sock, size=buffer_size)
-    if data_bytes is None:
-        return None  # Connection closed
+    return shape, np.dtype(dtype_str)
 
-    # Reconstruct the NumPy array
-    array = np.frombuffer(data_bytes, dtype=dtype).reshape(shape)
-    
-    return array
+
+# def recv_arrays(sock: socket.socket) -> list[np.ndarray] | None:
+def recv_arrays(sock: socket.socket) -> Union[list, None]:
+    """
+    Function to receive a list of NumPy arrays sent by send_arrays from the socket connection.
+    """
+    # Receive the number of arrays
+    count_bytes = recv_data(sock=sock, size=struct.calcsize("i"))
+    if count_bytes is None:
+        return None # Connection closed
+    count = struct.unpack("i", count_bytes)[0]
+
+    # Receive the headers of all arrays
+    headers = []
+    for _ in range(count):
+        header = recv_header(sock=sock)
+        if header is None:
+            return None # Connection closed
+        headers.append(header)
+
+    # Receive the data of all arrays into arrays from the pool
+    arrays = []
+    for shape, dtype in headers:
+        array = acquire_array(shape=shape, dtype=dtype)
+        if not recv_into(sock=sock, array=array):
+            return None  # Connection closed
+        arrays.append(array)
+
+    return arrays
+
+
+# def recv_schema(sock: socket.socket) -> list[np.ndarray] | None:
+def recv_schema(sock: socket.socket) -> Union[list, None]:
+    """
+    Function to receive the schema of messages sent by send_schema.
+    """
+    return recv_arrays(sock=sock)
+
+
+# def recv_message(sock: socket.socket, schema: list[np.ndarray]) -> tuple[int, list[np.ndarray]] | None:
+def recv_message(sock: socket.socket, schema: list) -> Union[tuple, None]:
+    """
+    Function to receive a timestamp and a list of NumPy arrays sent by send_message.
+    """
+    # Receive the timestamp and the lengths of the first dimension of all arrays
+    header = recv_data(sock=sock, size=struct.calcsize(f"q{len(schema)}i"))
+    if header is None:
+        return None # Connection closed
+    tic, *lengths = struct.unpack(f"q{len(schema)}i", header)
+
+    # Receive the data of all arrays into arrays from the pool
+    arrays = []
+    for length, template in zip(lengths, schema):
+        array = acquire_array(shape=(length,) + template.shape[1:], dtype=template.dtype)
+        if not recv_into(sock=sock, array=array):
+            return None  # Connection closed
+        arrays.append(array)
+
+    return tic, arrays
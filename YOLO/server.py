@@ -1,12 +1,11 @@
 import collections
 import socket
 import threading
-import time
 
 import numpy as np
 
-from aria_stream import parse_args, load_yolo, detect_objects, process_detections
-from communication import send_array, recv_array
+from aria_stream import MODEL_INPUT_SIZE, parse_args, load_yolo, detect_objects, process_detections
+from communication import configure_socket, decode_frame, jpeg_reduce, recv_message, recv_schema, release_array, send_message, send_schema
 
 
 # Server constants
@@ -20,13 +19,33 @@ sent_count = 0
 
 stop_event = threading.Event()  # --> event is created in False state
 
+# RESULT_SCHEMA is the layout of results sent to the client
+# (after the time in the header of each message):
+# boxes (N, 4), confidences (N,), and class_ids (N,)
+RESULT_SCHEMA = [
+    np.empty((0, 4), dtype="i2"),
+    np.empty((0,), dtype="f4"),
+    np.empty((0,), dtype="u1"),
+]
+
 # Global variables
-most_recent_frame = collections.deque(maxlen=1)
+# inference_in is a queue that stores a tuple of the most recent 
+# (time, image) received from the client. A new frame replaces 
+# a frame that was not taken by the inference thread yet.
+inference_in = collections.deque(maxlen=1)
+frame_ready = threading.Event()
+
+# results_out is a queue that stores tuples of 
+# (time, boxes, confidences, class_ids) to be sent to the client.
+results_out = collections.deque(maxlen=8)
+result_ready = threading.Event()
 
 
-def apply_model(img, net, output_layers):
+def apply_model(img, net, output_layers, scale=1):
 
+    # Boxes are returned in coordinates of the image upscaled by 'scale'
     height, width, channels = img.shape
+    height, width = height * scale, width * scale
     # print(height, width, channels)
 
     # YOLO object detection
@@ -34,43 +53,157 @@ def apply_model(img, net, output_layers):
     boxes, confidences, class_ids = process_detections(outputs, width, height)
     # print(boxes, confidences, class_ids)
 
-    boxes = np.array(boxes, dtype="i8")
+    # Use the smallest types that hold the values to send less bytes back:
+    # box coordinates are pixels of the image (int16), there are 80 classes (uint8)
+    boxes = np.array(boxes, dtype="i2").reshape(-1, 4)
     confidences = np.array(confidences, dtype="f4")
-    class_ids = np.array(class_ids, dtype="i8")
+    class_ids = np.array(class_ids, dtype="u1")
     # print(boxes, confidences, class_ids)
 
     return boxes, confidences, class_ids
 
 
+def release_image(arr: np.ndarray) -> None:
+    """
+    Return the memory of a received image to the pool.
+    """
+    # JPEG encoded images have a different length every time, 
+    # so it only makes sense to reuse raw images.
+    if arr.ndim == 3:
+        release_array(arr)
+
+
 def recv_thread(conn: socket.socket, stop_event: threading.Event) -> None:
     """
-    Thread function to receive arrays and add them to the queue.
+    Thread function to receive arrays and add them to the inference queue.
     """
-    global most_recent_frame, recv_count
+    global inference_in, recv_count
+
+    # Receive the layout of (time, image) messages once
+    schema = recv_schema(conn)
 
     while (1):
-        tic = recv_array(conn)
-        arr = recv_array(conn)
+        message = None if schema is None else recv_message(conn, schema)
 
-        if (tic is None) or (arr is None):
+        if message is None:
             stop_event.set()
             print(f"[{threading.current_thread().name}] Server received termination flag.", flush=True)
             break
         else:
-            most_recent_frame.append((tic, arr))
+            tic, (arr,) = message
+            # Give the memory of the frame which was not processed 
+            # back to the pool before it is replaced by the new one.
+            try:
+                stale_tic, stale_arr = inference_in.pop()
+                release_image(stale_arr)
+            except IndexError:
+                pass # Already taken by the inference thread
+            inference_in.append((tic, arr))
+            frame_ready.set()
             print(f"[{threading.current_thread().name}] Server received (time, image) and added to buffer.", flush=True)
             recv_count += 1
 
 
+def infer_thread(net, output_layers, stop_event: threading.Event) -> None:
+    """
+    Thread function to apply the model to the most recent frame and add results to the send queue.
+    """
+    global inference_in, results_out
+
+    while not stop_event.is_set():
+
+        # Wait for a new frame (with timeout to notice the stop event)
+        if not frame_ready.wait(timeout=0.1):
+            continue
+        frame_ready.clear()
+
+        try:
+            # Take the most recent frame from queue and associated time
+            tic, mrf = inference_in.pop()
+        except IndexError:
+            continue # Queue is empty
+
+        # Decompress the image if client sent JPEG. The image is 
+        # downscaled while decoding as long as it stays larger than the input 
+        # of the model, which blobFromImage resizes it to anyway. A frame 
+        # that cannot be decoded is skipped, the connection stays open.
+        try:
+            scale = jpeg_reduce(mrf, min_size=MODEL_INPUT_SIZE)
+            img = decode_frame(mrf, reduce=scale)
+        except OSError:
+            img = None # Corrupt JPEG data (turbojpeg)
+        if img is None:
+            print(f"[{threading.current_thread().name}] Server could not decode image. Skipping.", flush=True)
+            release_image(mrf)
+            continue
+
+        # Apply model. An error here would repeat for every frame, so 
+        # it is reported and closes the connection instead of silently 
+        # stopping this thread while frames are still being received.
+        try:
+            boxes, confidences, class_ids = apply_model(
+                img=img, 
+                net=net,
+                output_layers=output_layers,
+                scale=scale
+            )
+        except Exception as e:
+            print(f"[{threading.current_thread().name}] Inference error: {e}", flush=True)
+            release_image(mrf)
+            stop_event.set()
+            return
+
+        # Return the image memory to the pool for the next recv_message
+        release_image(mrf)
+
+        results_out.append((tic, boxes, confidences, class_ids))
+        result_ready.set()
+
+
+def send_thread(conn: socket.socket, stop_event: threading.Event) -> None:
+    """
+    Thread function to send results from the send queue to the client.
+    """
+    global results_out, sent_count
+
+    while not stop_event.is_set():
+
+        # Wait for new results (with timeout to notice the stop event)
+        if not result_ready.wait(timeout=0.1):
+            continue
+        result_ready.clear()
+
+        while results_out:
+            tic, boxes, confidences, class_ids = results_out.popleft()
+
+            # Added a try-except block around the data sending section
+            # to catch and handle errors related to broken connections,
+            # e.g., when a client has been disconnected, so server cannot 
+            # send message back.
+            try:
+                # Send model artefacts as one message
+                send_message(conn, tic, [boxes, confidences, class_ids])
+            except (BrokenPipeError, ConnectionResetError) as e:
+                print(f"Connection error: {e}", flush=True)
+                stop_event.set()
+                return
+
+            print(f"[{threading.current_thread().name}] Server processed image and sent (tic, boxes, confidences, class_ids) to client.", flush=True)
+            sent_count += 1
+
+
 def run_server(net, output_layers):
     """
     Main server function.
     """
     global sent_count
     global recv_count
-    global most_recent_frame
+    global inference_in
+    global results_out
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        # Accepted connections inherit the buffer sizes of the listening socket
+        configure_socket(server)
         server.bind((SERVER_HOST, SERVER_PORT))
         server.listen(1)
         print(f"[{threading.current_thread().name}] Server listening on {SERVER_HOST}:{SERVER_PORT}", flush=True)
@@ -78,55 +211,31 @@ def run_server(net, output_layers):
         while (1):
 
             conn, addr = server.accept()
+            configure_socket(conn)
             print(f"[{threading.current_thread().name}] Connected by {addr}", flush=True)
 
-            # Recieve frames
+            # Send the layout of results once
+            send_schema(conn, RESULT_SCHEMA)
+
+            # Recieve frames, apply model and send results in separate threads,
+            # so that receiving and sending overlap with inference
             camera = threading.Thread(target=recv_thread, args=(conn, stop_event), name="RecvThread")
+            model = threading.Thread(target=infer_thread, args=(net, output_layers, stop_event), name="InferThread")
+            sender = threading.Thread(target=send_thread, args=(conn, stop_event), name="SendThread")
             camera.start()
+            model.start()
+            sender.start()
 
-            while True:
-                if stop_event.is_set():
-                    break
-
-                if most_recent_frame:
-
-                    # Added a try-except block around the data sending section
-                    # to catch and handle errors related to broken connections,
-                    # e.g., when a client has been disconnected, so server cannot 
-                    # send message back.
-
-                    try:
-                        if len(most_recent_frame) > 0:
-
-                            # Take the most recent frame from queue and associated time
-                            tic, mrf = most_recent_frame.pop()
-
-                            # Apply model
-                            boxes, confidences, class_ids = apply_model(
-                                img=mrf, 
-                                net=net,
-                                output_layers=output_layers
-                            )
-
-                            # Send model artefacts
-                            send_array(conn, tic)
-                            send_array(conn, boxes)
-                            send_array(conn, confidences)
-                            send_array(conn, class_ids)
-
-                            print(f"[{threading.current_thread().name}] Server processed image and sent (tic, boxes, confidences, class_ids) to client.", flush=True)
-                            sent_count += 1
-                        
-                        else:
-                            continue
-
-
-                    except (BrokenPipeError, ConnectionResetError) as e:
-                        print(f"Connection error: {e}", flush=True)
-                        break  # Break out of the inner loop to accept a new connection
+            # Inference and send threads stop when the stop event is set
+            model.join()
+            sender.join()
 
-                else:
-                    time.sleep(0.1)  # Wait if queue is empty
+            # Unblock the receive thread if the connection was broken while sending
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass # Already disconnected
+            camera.join()
 
             conn.close()
             stop_event.clear()
@@ -137,10 +246,13 @@ def run_server(net, output_layers):
             print(f"[{threading.current_thread().name}] sent_count={sent_count}", flush=True)
             print(f"[{threading.current_thread().name}] recv_count={recv_count}", flush=True)
             
-            # Reset counters for new client connection
+            # Reset counters and queues for new client connection
             sent_count = 0
             recv_count = 0
-            most_recent_frame = collections.deque(maxlen=1)
+            inference_in = collections.deque(maxlen=1)
+            results_out = collections.deque(maxlen=8)
+            frame_ready.clear()
+            result_ready.clear()
 
             print(f"", flush=True)
             print(f"[{threading.current_thread().name}] Server listening on {SERVER_HOST}:{SERVER_PORT}", flush=True)